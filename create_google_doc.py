@@ -12,6 +12,7 @@ from googleapiclient.discovery import build
 DOC_NAME = "TEST DOC FROM CODEX"
 FOLDER_NAME = "ИИ ТЕСТЫ"
 SCOPES = ["https://www.googleapis.com/auth/drive"]
+REQUIRED_SERVICE_ACCOUNT_FIELDS = ("client_email", "private_key", "token_uri")
 
 
 def load_service_account_info() -> dict:
@@ -19,13 +20,24 @@ def load_service_account_info() -> dict:
     if not raw:
         raise RuntimeError("GOOGLE_SERVICE_ACCOUNT_JSON is not set.")
     try:
-        return json.loads(raw)
+        info = json.loads(raw)
     except json.JSONDecodeError as exc:
         raise RuntimeError("GOOGLE_SERVICE_ACCOUNT_JSON is not valid JSON.") from exc
 
+    if not isinstance(info, dict):
+        raise RuntimeError("GOOGLE_SERVICE_ACCOUNT_JSON must be a JSON object.")
+
+    missing = [field for field in REQUIRED_SERVICE_ACCOUNT_FIELDS if not info.get(field)]
+    if missing:
+        raise RuntimeError(
+            "GOOGLE_SERVICE_ACCOUNT_JSON is missing required fields: "
+            + ", ".join(missing)
+        )
+    return info
+
 
 def find_folder_id(service, folder_name: str) -> Optional[str]:
-    escaped_name = folder_name.replace("'", "\\'")
+    escaped_name = folder_name.replace("\\", "\\\\").replace("'", "\\'")
     query = (
         "mimeType = 'application/vnd.google-apps.folder' "
         "and trashed = false "
@@ -33,7 +45,7 @@ def find_folder_id(service, folder_name: str) -> Optional[str]:
     )
     response = (
         service.files()
-        .list(q=query, fields="files(id, name)")
+        .list(q=query, fields="files(id)", pageSize=1, spaces="drive")
         .execute()
     )
     folders = response.get("files", [])
@@ -1,15 +1,50 @@
+import atexit
+import logging
 import os
+import queue
+import threading
+import time
 from dataclasses import dataclass
-from typing import Any, Dict, Optional, Tuple
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Callable, Dict, List, Optional, Tuple
 from urllib.error import URLError
 from urllib.request import urlopen
 
 import requests
 from flask import Flask, jsonify, request
+from flask.logging import default_handler
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
 SERVER_PORT = 8000
 
+COMMENT_MAX_LENGTH = 2000
+
+CONTACT_CACHE_TTL = 600.0
+CONTACT_CACHE_MAXSIZE = 10_000
+
+# Shared by all Bitrix calls so TCP/TLS connections to the portal are reused.
+_HTTP_SESSION = requests.Session()
+# Only connection failures are retried: Bitrix calls are POSTs that may create
+# records, so replaying them after a response or a read error is not safe.
+_HTTP_ADAPTER = HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=32,
+    max_retries=Retry(total=3, connect=3, read=0, status=0, backoff_factor=0.2),
+)
+_HTTP_SESSION.mount("https://", _HTTP_ADAPTER)
+_HTTP_SESSION.mount("http://", _HTTP_ADAPTER)
+
+# Sent with every contact add/update; never mutated.
+_CONTACT_PARAMS = {"REGISTER_SONET_EVENT": "Y"}
+
+_PUBLIC_URL_LOCK = threading.Lock()
+
+# (webhook, phone, email) -> (expires_at, contact_id); insertion order is age order.
+_CONTACT_CACHE: Dict[Tuple[str, str, str], Tuple[float, int]] = {}
+_CONTACT_CACHE_LOCK = threading.Lock()
+
 
 class BitrixConfigurationError(RuntimeError):
     """Raised when the Bitrix configuration is incomplete."""
@@ -19,7 +54,7 @@ class BitrixRequestError(RuntimeError):
     """Raised when Bitrix reports an error or the request fails."""
 
 
-@dataclass
+@dataclass(frozen=True)
 class BitrixConfig:
     inbound_webhook: Optional[str]
     outbound_webhook: Optional[str]
@@ -34,14 +69,56 @@ class BitrixConfig:
         )
 
 
+@dataclass(frozen=True)
+class BitrixHookPayload:
+    name: str
+    # Passed through as sent: a plain string or a Bitrix-style multi-field list.
+    phone: Any
+    email: Any
+    assigned_id: Optional[int]
+    comment: Optional[str]
+    message: Optional[str]
+    dialog_id: Optional[str]
+
+    @classmethod
+    def from_json(cls, payload: Dict[str, Any]) -> "BitrixHookPayload":
+        """Collapse the lower-case and Bitrix-style upper-case field aliases.
+
+        Raises ``ValueError`` with a client-facing message if ``name`` is missing
+        or the assigned user ID is not an integer.
+        """
+
+        get = payload.get
+        name = get("name") or get("NAME")
+        if not name:
+            raise ValueError("Missing required field 'name'")
+
+        assigned_key = "assigned_id" if get("assigned_id") else "ASSIGNED_BY_ID"
+        assigned = get(assigned_key)
+        try:
+            assigned_id = int(assigned) if assigned is not None else None
+        except (TypeError, ValueError) as exc:
+            raise ValueError(f"Field '{assigned_key}' must be an integer") from exc
+
+        return cls(
+            name=name,
+            phone=get("phone") or get("PHONE"),
+            email=get("email") or get("EMAIL"),
+            assigned_id=assigned_id,
+            comment=get("comment") or get("COMMENTS"),
+            message=get("message") or get("MESSAGE"),
+            dialog_id=get("dialog_id") or get("DIALOG_ID"),
+        )
+
+
 def _clean_url(value: Optional[str]) -> Optional[str]:
     if not value:
         return None
     return value.rstrip("/")
 
 
-def determine_public_url(port: int) -> Optional[str]:
-    """Attempt to determine a publicly reachable URL for the service."""
+def configured_public_url() -> Optional[str]:
+    """Return the public URL configured through the environment, if any."""
 
     env_url = os.environ.get("PUBLIC_URL")
     if env_url:
@@ -52,6 +129,16 @@ def determine_public_url(port: int) -> Optional[str]:
         scheme = os.environ.get("PUBLIC_SCHEME", "https")
         return f"{scheme}://{env_host.rstrip('/')}"
 
+    return None
+
+
+def determine_public_url(port: int) -> Optional[str]:
+    """Attempt to determine a publicly reachable URL for the service."""
+
+    configured = configured_public_url()
+    if configured:
+        return configured
+
     try:
         with urlopen("https://ifconfig.me/ip", timeout=5) as response:
             ip = response.read().decode("utf-8").strip()
@@ -67,6 +154,35 @@ def determine_public_url(port: int) -> Optional[str]:
     return f"http://{ip}:{port}"
 
 
+def start_public_url_discovery(
+    app: Flask, on_resolved: Optional[Callable[[Optional[str]], None]] = None
+) -> None:
+    """Resolve the public URL on a background thread and cache it on the app.
+
+    Only the first call starts a lookup; later calls return immediately. When the
+    URL is already known (e.g. configured via the environment) no thread is started.
+    """
+
+    cached = app.config.get("_cached_public_url")
+    if cached is not None:
+        if on_resolved is not None:
+            on_resolved(cached or None)
+        return
+
+    with _PUBLIC_URL_LOCK:
+        if app.config.get("_public_url_discovery_started"):
+            return
+        app.config["_public_url_discovery_started"] = True
+
+        def discover() -> None:
+            url = determine_public_url(app.config["SERVER_PORT"])
+            app.config["_cached_public_url"] = url or ""
+            if on_resolved is not None:
+                on_resolved(url)
+
+    threading.Thread(target=discover, name="public-url-discovery", daemon=True).start()
+
+
 def b24_request(config: BitrixConfig, method: str, payload: Dict) -> Any:
     """Call a Bitrix inbound webhook method and return the JSON payload."""
 
@@ -78,7 +194,7 @@ def b24_request(config: BitrixConfig, method: str, payload: Dict) -> Any:
     url = f"{config.inbound_webhook}/{method}.json"
 
     try:
-        response = requests.post(url, json=payload, timeout=10)
+        response = _HTTP_SESSION.post(url, json=payload, timeout=10)
         response.raise_for_status()
         data = response.json()
     except requests.RequestException as exc:
@@ -101,13 +217,52 @@ def b24_im(config: BitrixConfig, dialog_id: str, text: str) -> None:
     url = f"{config.outbound_webhook}/im.message.add.json"
     payload = {"DIALOG_ID": str(dialog_id), "MESSAGE": text}
     try:
-        response = requests.post(url, json=payload, timeout=10)
+        response = _HTTP_SESSION.post(url, json=payload, timeout=10)
         response.raise_for_status()
     except requests.RequestException as exc:
         raise BitrixRequestError(f"Failed to send chat message: {exc}") from exc
 
 
-def find_contact_by_comm(config: BitrixConfig, phone: Optional[str], email: Optional[str]) -> Optional[int]:
+def _contact_cache_key(
+    config: BitrixConfig, phone: Any, email: Any
+) -> Optional[Tuple[str, str, str]]:
+    # Payloads may carry Bitrix-style multi-field lists; only plain strings are cached.
+    if not isinstance(phone, (str, type(None))) or not isinstance(email, (str, type(None))):
+        return None
+    return (config.inbound_webhook or "", phone or "", email or "")
+
+
+def _get_cached_contact(key: Tuple[str, str, str]) -> Optional[int]:
+    with _CONTACT_CACHE_LOCK:
+        entry = _CONTACT_CACHE.get(key)
+        if entry is None:
+            return None
+        expires_at, contact_id = entry
+        if expires_at <= time.monotonic():
+            del _CONTACT_CACHE[key]
+            return None
+        return contact_id
+
+
+def _cache_contact(key: Tuple[str, str, str], contact_id: int) -> None:
+    with _CONTACT_CACHE_LOCK:
+        _CONTACT_CACHE.pop(key, None)
+        _CONTACT_CACHE[key] = (time.monotonic() + CONTACT_CACHE_TTL, contact_id)
+        while len(_CONTACT_CACHE) > CONTACT_CACHE_MAXSIZE:
+            del _CONTACT_CACHE[next(iter(_CONTACT_CACHE))]
+
+
+def _forget_contact(key: Tuple[str, str, str]) -> None:
+    with _CONTACT_CACHE_LOCK:
+        _CONTACT_CACHE.pop(key, None)
+
+
+def find_contact_by_comm(
+    config: BitrixConfig,
+    phone: Optional[str],
+    email: Optional[str],
+    use_cache: bool = True,
+) -> Optional[int]:
     communications = []
     if phone:
         communications.append({"TYPE": "PHONE", "VALUE": phone})
@@ -117,6 +272,12 @@ def find_contact_by_comm(config: BitrixConfig, phone: Optional[str], email: Opti
     if not communications:
         return None
 
+    cache_key = _contact_cache_key(config, phone, email)
+    if use_cache and cache_key is not None:
+        cached_id = _get_cached_contact(cache_key)
+        if cached_id is not None:
+            return cached_id
+
     result = b24_request(
         config,
         "crm.duplicate.findbycomm",
@@ -127,7 +288,33 @@ def find_contact_by_comm(config: BitrixConfig, phone: Optional[str], email: Opti
     if not contact_ids:
         return None
 
-    return int(contact_ids[0])
+    contact_id = int(contact_ids[0])
+    if cache_key is not None:
+        _cache_contact(cache_key, contact_id)
+    return contact_id
+
+
+def _multifield(value: Optional[str]) -> list:
+    return [{"VALUE": value, "VALUE_TYPE": "WORK"}] if value else []
+
+
+def _contact_fields(
+    name: str, phone: Optional[str], email: Optional[str], comment: Optional[str]
+) -> Dict[str, Any]:
+    return {
+        "NAME": name or "—",
+        "PHONE": _multifield(phone),
+        "EMAIL": _multifield(email),
+        "COMMENTS": (comment or "")[:COMMENT_MAX_LENGTH],
+    }
+
+
+def _update_contact(config: BitrixConfig, contact_id: int, fields: Dict[str, Any]) -> None:
+    b24_request(
+        config,
+        "crm.contact.update",
+        {"id": contact_id, "fields": fields, "params": _CONTACT_PARAMS},
+    )
 
 
 def upsert_contact(
@@ -138,58 +325,98 @@ def upsert_contact(
     assigned_id: Optional[int] = None,
     comment: Optional[str] = None,
 ) -> Tuple[int, str]:
-    contact_id = find_contact_by_comm(config, phone, email)
+    fields = _contact_fields(name, phone, email, comment)
 
-    fields = {
-        "NAME": name or "—",
-        "PHONE": ([{"VALUE": phone, "VALUE_TYPE": "WORK"}] if phone else []),
-        "EMAIL": ([{"VALUE": email, "VALUE_TYPE": "WORK"}] if email else []),
-        "COMMENTS": (comment or "")[:2000],
-    }
+    cache_key = _contact_cache_key(config, phone, email)
+    cached_id = _get_cached_contact(cache_key) if cache_key is not None else None
+    if cached_id is not None:
+        try:
+            _update_contact(config, cached_id, fields)
+            return cached_id, "updated"
+        except BitrixRequestError:
+            # The cached id may point at a contact that was merged or deleted;
+            # forget it and retry once against a fresh lookup below.
+            _forget_contact(cache_key)
 
-    params = {"REGISTER_SONET_EVENT": "Y"}
+    contact_id = find_contact_by_comm(config, phone, email, use_cache=False)
 
     if contact_id:
-        b24_request(
-            config,
-            "crm.contact.update",
-            {"id": contact_id, "fields": fields, "params": params},
-        )
+        _update_contact(config, contact_id, fields)
         return contact_id, "updated"
 
     if assigned_id is not None:
         fields["ASSIGNED_BY_ID"] = int(assigned_id)
 
-    new_id = b24_request(
-        config,
-        "crm.contact.add",
-        {"fields": fields, "params": params},
+    new_id = int(
+        b24_request(
+            config,
+            "crm.contact.add",
+            {"fields": fields, "params": _CONTACT_PARAMS},
+        )
     )
 
-    return int(new_id), "created"
+    if cache_key is not None and (phone or email):
+        _cache_contact(cache_key, new_id)
+
+    return new_id, "created"
+
+
+class _ProcessLocalQueueHandler(QueueHandler):
+    """QueueHandler whose listener thread is started by the first record each process emits.
+
+    Threads do not survive fork, so starting the listener at import time would leave
+    pre-forked workers (e.g. gunicorn --preload) with a queue nobody drains.
+    """
+
+    def __init__(self, handlers: List[logging.Handler]) -> None:
+        super().__init__(queue.Queue(-1))
+        self._handlers = handlers
+        self._listener_pid: Optional[int] = None
+        self._listener_lock = threading.Lock()
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if self._listener_pid != os.getpid():
+            self._start_listener()
+        super().emit(record)
+
+    def _start_listener(self) -> None:
+        with self._listener_lock:
+            pid = os.getpid()
+            if self._listener_pid == pid:
+                return
+            # A queue inherited from the parent may hold records it already handled.
+            self.queue = queue.Queue(-1)
+            listener = QueueListener(self.queue, *self._handlers, respect_handler_level=True)
+            listener.start()
+            atexit.register(listener.stop)
+            self._listener_pid = pid
+
+
+def _configure_logging(app: Flask) -> None:
+    """Hand log records to a background listener so request threads never block on I/O."""
+
+    # Flask only installs default_handler when nothing upstream handles the logger
+    # (and it is gone once the queue is attached); leave other setups untouched.
+    if default_handler not in app.logger.handlers:
+        return
+
+    handlers = list(app.logger.handlers)
+    for handler in handlers:
+        app.logger.removeHandler(handler)
+    app.logger.addHandler(_ProcessLocalQueueHandler(handlers))
 
 
 def create_app(port: int = SERVER_PORT) -> Flask:
     """Create and configure the Flask application."""
 
     app = Flask(__name__)
+    _configure_logging(app)
     app.config["SERVER_PORT"] = port
-    app.config.setdefault("_cached_public_url", None)
+    # Environment overrides need no network call, so they are known immediately.
+    app.config.setdefault("_cached_public_url", configured_public_url())
+    app.config.setdefault("_public_url_discovery_started", False)
     app.config["BITRIX"] = BitrixConfig.from_env()
 
-    def resolve_public_url() -> Optional[str]:
-        cached = app.config.get("_cached_public_url")
-        if cached is not None:
-            return cached or None
-
-        url = determine_public_url(app.config["SERVER_PORT"])
-        if url:
-            app.config["_cached_public_url"] = url
-            return url
-
-        app.config["_cached_public_url"] = ""
-        return None
-
     @app.route("/")
     def home():
         """Return a simple status message for health checks."""
@@ -209,25 +436,22 @@ def create_app(port: int = SERVER_PORT) -> Flask:
             app.logger.warning("Failed to parse JSON payload on /bitrix_hook: %r", payload)
             return jsonify({"error": "Invalid JSON payload"}), 400
 
-        name = payload.get("name") or payload.get("NAME")
-        if not name:
-            return jsonify({"error": "Missing required field 'name'"}), 400
-
-        phone = payload.get("phone") or payload.get("PHONE")
-        email = payload.get("email") or payload.get("EMAIL")
-        assigned = payload.get("assigned_id") or payload.get("ASSIGNED_BY_ID")
-        comment = payload.get("comment") or payload.get("COMMENTS")
+        try:
+            hook = BitrixHookPayload.from_json(payload)
+        except ValueError as exc:
+            return jsonify({"error": str(exc)}), 400
 
         config: BitrixConfig = app.config["BITRIX"]
+        dialog_id = hook.dialog_id or config.default_dialog
 
         try:
             contact_id, status = upsert_contact(
                 config,
-                name=name,
-                phone=phone,
-                email=email,
-                assigned_id=int(assigned) if assigned is not None else None,
-                comment=comment,
+                name=hook.name,
+                phone=hook.phone,
+                email=hook.email,
+                assigned_id=hook.assigned_id,
+                comment=hook.comment,
             )
         except BitrixConfigurationError as exc:
             app.logger.error("Bitrix configuration error: %s", exc)
@@ -236,13 +460,10 @@ def create_app(port: int = SERVER_PORT) -> Flask:
             app.logger.exception("Bitrix request failed")
             return jsonify({"error": str(exc)}), 502
 
-        message = payload.get("message") or payload.get("MESSAGE")
-        dialog_id = payload.get("dialog_id") or payload.get("DIALOG_ID") or config.default_dialog
-
         chat_status = None
-        if message:
+        if hook.message:
             try:
-                b24_im(config, dialog_id, message)
+                b24_im(config, dialog_id, hook.message)
                 chat_status = "sent"
             except BitrixConfigurationError as exc:
                 app.logger.error("Bitrix chat configuration error: %s", exc)
@@ -263,7 +484,9 @@ def create_app(port: int = SERVER_PORT) -> Flask:
     def public_url():
         """Return the best-known public URL for the running service."""
 
-        url = resolve_public_url()
+        url = app.config.get("_cached_public_url")
+        if url is None:
+            start_public_url_discovery(app)
         if not url:
             url = request.host_url.rstrip("/")
         return jsonify({"public_url": url}), 200
@@ -275,17 +498,11 @@ app = create_app()
 
 
 if __name__ == "__main__":
-    discovered_url = app.config.get("_cached_public_url")
-    if not discovered_url:
-        discovered_url = determine_public_url(SERVER_PORT)
-        if discovered_url:
-            app.config["_cached_public_url"] = discovered_url
+    def report_public_url(url: Optional[str]) -> None:
+        if url:
+            print(f"🌐 Public URL: {url}")
         else:
-            app.config["_cached_public_url"] = ""
-
-    if discovered_url:
-        print(f"🌐 Public URL: {discovered_url}")
-    else:
-        print("⚠️  Unable to determine the public URL automatically.")
+            print("⚠️  Unable to determine the public URL automatically.")
 
+    start_public_url_discovery(app, report_public_url)
     app.run(host="0.0.0.0", port=SERVER_PORT)